@@ -12,7 +12,6 @@ import ee
 import numpy as np
 import pandas as pd
 import hashlib
-import PIL
 import requests
 import os
 import joblib
@@ -26,8 +25,9 @@ import copy
 import re
 import time
 import warnings
-import geojson
-from io import BytesIO
+import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime as dt
 from datetime import timedelta as td
 
@@ -55,10 +55,16 @@ class Abyo:
   anomaly                     = 1
   dummy                       = -99999
   max_tile_pixels             = 10000000 # if higher, will split the geometry into tiles
+  n_jobs                      = 8 # parallel workers used on GEE requests
+  n_jobs_download             = 16 # parallel workers used on images downloads
+
+  # rgb bands of each Landsat product (by product id prefix)
+  landsat_rgb_bands           = {prefix: [gee.get_sensor_params(sensor)['red'], gee.get_sensor_params(sensor)['green'], gee.get_sensor_params(sensor)['blue']] for prefix, sensor in [('LT05', 'landsat5'), ('LE07', 'landsat7'), ('LC08', 'landsat')]}
 
   # supports
   dates_timeseries            = [None, None]
   dates_timeseries_interval   = []
+  dates_timeseries_ids        = {}
   sensor_params               = None
 
   # sample variables
@@ -70,11 +76,14 @@ class Abyo:
 
   # masks
   water_mask                  = None
+  kernel_square               = None
+  kernel_circle               = None
   
   # collections
   collection                  = None
   collection_water            = None
   collection_yearly           = None
+  images_yearly               = None
 
   # attributes used in timeseries
   attributes                  = ['cloud', 'label', 'occurrence', 'not_occurrence']
@@ -84,7 +93,7 @@ class Abyo:
   df_timeseries               = None
 
   # hash
-  hash_string                 = "abyo-20210617"
+  hash_string                 = "abyo-20261015"
 
   # constructor
   def __init__(self,
@@ -100,7 +109,10 @@ class Abyo:
                morph_op_iters:    int           = 1,
                indice:            str           = "mndwi,ndvi,fai,sabi,slope",
                min_occurrence:    int           = 4,
-               shapefile:         str           = None):
+               shapefile:         str           = None,
+               n_jobs:            int           = 8,
+               max_rps:           float         = None,
+               fetch_mode:        str           = "getDownloadUrl"):
     
     # get sensor parameters
     self.sensor_params  = gee.get_sensor_params(sensor)
@@ -123,10 +135,20 @@ class Abyo:
     self.morph_op_iters               = morph_op_iters
     self.shapefile_url                = shapefile
     self.shapefile                    = ee.FeatureCollection(self.shapefile_url) if self.shapefile_url else None
+    self.n_jobs                       = max(1, int(n_jobs))
+    self.fetch_mode                   = fetch_mode
+
+    # http session used in downloads (keep-alive connections, with retries)
+    self.http                         = requests.Session()
+    self.http.mount('https://', HTTPAdapter(pool_connections=self.n_jobs_download, pool_maxsize=self.n_jobs_download, max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])))
 
     # change GEE indice selected
     gee.indice_selected               = indice
     gee.min_occurrence                = min_occurrence
+    gee.max_requests_per_second       = max_rps
+
+    # cache hash prefix (parameters shared by all cache files)
+    self.hash_prefix                  = hashlib.blake2b(self.hash_string.encode()+str(str(self.date_start)+str(self.date_end)+str(self.date_start2)+str(self.date_end2)).encode()+self.lat_lon.encode()+self.sensor.encode()+str(self.morph_op).encode()+str(self.morph_op_iters).encode()+str(gee.indice_selected).encode()+str(gee.min_occurrence).encode()+str(self.shapefile_url).encode(), digest_size=16)
 
     # creating final sensor collection
     collection, collection_water      = gee.get_sensor_collections(geometry=self.geometry, sensor=self.sensor, dates=[dt.strftime(self.date_start, "%Y-%m-%d"), dt.strftime(self.date_end, "%Y-%m-%d")])
@@ -137,12 +159,38 @@ class Abyo:
       collection = collection.merge(collection2)
       collection_water = collection_water.merge(collection_water2)
 
+    # request collection statistics at once (single round-trip to GEE)
+    try:
+
+      # user disabled cache
+      if self.force_cache or not self.cache_path:
+        raise Exception()
+
+      # extract collection statistics from cache
+      collection_info                 = joblib.load(self.get_cache_file('collection_days'))
+
+    # statistics not in cache, request them from GEE and save them in the end
+    except:
+      days                            = collection.aggregate_array('system:time_start').map(lambda ms: ee.Date(ms).format('YYYY-MM-dd'))
+      collection_info                 = ee.Dictionary({
+                                          'size': collection.size(),
+                                          'time_start': collection.aggregate_min('system:time_start'),
+                                          'time_end': collection.aggregate_max('system:time_start'),
+                                          'days': days,
+                                          'unique_days': days.distinct().sort(),
+                                          'ids': collection.aggregate_array('system:id'),
+                                          'water_size': collection_water.size()
+                                        })
+      collection_info                 = gee.get_info(collection_info)
+      if self.cache_path and collection_info['size'] > 0:
+        joblib.dump(collection_info, self.get_cache_file('collection_days'))
+
     # check if there is imags to use
-    if collection.size().getInfo() > 0:
+    if collection_info['size'] > 0:
 
       # correc time series date start and end
-      self.dates_timeseries[0]          = dt.fromtimestamp(collection.filterBounds(self.geometry).sort('system:time_start', True).first().get('system:time_start').getInfo()/1000.0)
-      self.dates_timeseries[1]          = dt.fromtimestamp(collection.filterBounds(self.geometry).sort('system:time_start', False).first().get('system:time_start').getInfo()/1000.0)
+      self.dates_timeseries[0]          = dt.fromtimestamp(collection_info['time_start']/1000.0)
+      self.dates_timeseries[1]          = dt.fromtimestamp(collection_info['time_end']/1000.0)
 
       # create usefull time series
       if self.shapefile:
@@ -150,27 +198,45 @@ class Abyo:
       else:
         self.collection = collection
       self.collection_water             = collection_water
-      self.dates_timeseries_interval    = misc.remove_duplicated_dates([dt.fromtimestamp(d/1000.0).replace(hour=00, minute=00, second=00) for d in self.collection.aggregate_array("system:time_start").getInfo()])
+      self.dates_timeseries_interval    = [dt.strptime(day, "%Y-%m-%d") for day in collection_info['unique_days']]
+
+      # first image id of each day (UTC, as in GEE date filters)
+      self.dates_timeseries_ids         = {}
+      for day, image_id in zip(collection_info['days'], collection_info['ids']):
+        self.dates_timeseries_ids.setdefault(day, image_id)
 
       # build yearly collection for label band
-      self.years_list                   = ee.List.sequence(ee.Number(int(self.dates_timeseries[0].strftime("%Y"))), ee.Number(int(self.dates_timeseries[1].strftime("%Y"))))
-      self.collection_yearly            = ee.ImageCollection.fromImages(self.years_list.map(lambda y: self.collection.filter(ee.Filter.calendarRange(y, y, 'year')).sum().set('year', y)))
-      self.years_list                   = self.years_list.getInfo()
+      self.years_list                   = list(range(int(self.dates_timeseries[0].strftime("%Y")), int(self.dates_timeseries[1].strftime("%Y"))+1))
+      self.collection_yearly            = ee.ImageCollection.fromImages(ee.List(self.years_list).map(lambda y: self.collection.filter(ee.Filter.calendarRange(y, y, 'year')).sum().set('year', y)))
+      self.images_yearly                = {}
 
       # preprocessing - water mask extraction
       self.water_mask                   = self.create_water_mask(self.morph_op, self.morph_op_iters)
 
       # count sample pixels and get sample min max coordinates
       self.sample_clip                  = self.clip_image(ee.Image(abs(self.dummy)))
-      self.sample_total_pixel           = gee.get_image_counters(image=self.sample_clip.select("constant"), geometry=self.geometry, scale=self.sensor_params['scale'])["constant"]
-      coordinates_min, coordinates_max  = gee.get_image_min_max(image=self.sample_clip, geometry=self.geometry, scale=self.sensor_params['scale'])
-      self.sample_lon_lat               = [[float(coordinates_min['latitude']),float(coordinates_min['longitude'])],[float(coordinates_max['latitude']),float(coordinates_max['longitude'])]]
+      try:
+
+        # user disabled cache
+        if self.force_cache or not self.cache_path:
+          raise Exception()
+
+        # extract sample statistics from cache
+        self.sample_total_pixel, self.sample_lon_lat = joblib.load(self.get_cache_files()[2])
+
+      # statistics not in cache, request them from GEE and save them in the end
+      except:
+        sample_statistics               = gee.get_image_counters_min_max(image=self.sample_clip.select("constant"), geometry=self.geometry, scale=self.sensor_params['scale'])
+        self.sample_total_pixel         = sample_statistics["constant_count"]
+        self.sample_lon_lat             = [[float(sample_statistics['latitude_min']),float(sample_statistics['longitude_min'])],[float(sample_statistics['latitude_max']),float(sample_statistics['longitude_max'])]]
+        if self.cache_path:
+          joblib.dump([self.sample_total_pixel, self.sample_lon_lat], self.get_cache_files()[2])
 
       # split geometry in tiles
       self.splitted_geometry            = self.split_geometry()
 
       # warning
-      print("Statistics: scale="+str(self.sensor_params['scale'])+" meters, pixels="+str(self.sample_total_pixel)+", date_start='"+self.dates_timeseries[0].strftime("%Y-%m-%d")+"', date_end='"+self.dates_timeseries[1].strftime("%Y-%m-%d")+"', tiles='"+str(len(self.splitted_geometry))+"', interval_images='"+str(self.collection.size().getInfo())+"', interval_unique_images='"+str(len(self.dates_timeseries_interval))+"', yearly_images='"+str(self.collection_yearly.size().getInfo())+"', water_mask_images='"+str(self.collection_water.size().getInfo())+"', morph_op='"+str(self.morph_op)+"', morph_op_iters='"+str(self.morph_op_iters)+"'")
+      print("Statistics: scale="+str(self.sensor_params['scale'])+" meters, pixels="+str(self.sample_total_pixel)+", date_start='"+self.dates_timeseries[0].strftime("%Y-%m-%d")+"', date_end='"+self.dates_timeseries[1].strftime("%Y-%m-%d")+"', tiles='"+str(len(self.splitted_geometry))+"', interval_images='"+str(collection_info['size'])+"', interval_unique_images='"+str(len(self.dates_timeseries_interval))+"', yearly_images='"+str(len(self.years_list))+"', water_mask_images='"+str(collection_info['water_size'])+"', morph_op='"+str(self.morph_op)+"', morph_op_iters='"+str(self.morph_op_iters)+"'")
 
     # error, no images found
     else:
@@ -186,24 +252,27 @@ class Abyo:
   # create the water mask
   def create_water_mask(self, morph_op: str = None, morph_op_iters: int = 1):
 
-    # water mask
+    # water mask (only the water band is reduced, using GEE parallel reduction)
     if self.sensor == "modis":
-      water_mask = self.collection_water.mode().select('water_mask').eq(1)
+      water_mask = self.collection_water.select('water_mask').reduce(ee.Reducer.mode(), parallelScale=4).select('water_mask_mode').eq(1)
     elif "landsat" in self.sensor:
-      water_mask = self.collection_water.mode().select('water').eq(2)
+      water_mask = self.collection_water.select('water').reduce(ee.Reducer.mode(), parallelScale=4).select('water_mode').eq(2)
     else:
-      water_mask = self.collection_water.mode().select('water').gt(0)
+      water_mask = self.collection_water.select('water').reduce(ee.Reducer.mode(), parallelScale=4).select('water_mode').gt(0)
 
-    # morphological operations
+    # morphological operations (kernels are created once, after GEE initialization)
     if not morph_op is None and morph_op != '':
+      if Abyo.kernel_square is None:
+        Abyo.kernel_square  = ee.Kernel.square(radius=1)
+        Abyo.kernel_circle  = ee.Kernel.circle(radius=1)
       if morph_op   == 'closing':
-        water_mask = water_mask.focal_max(kernel=ee.Kernel.square(radius=1), iterations=morph_op_iters).focal_min(kernel=ee.Kernel.circle(radius=1), iterations=morph_op_iters)
+        water_mask = water_mask.focal_max(kernel=self.kernel_square, iterations=morph_op_iters).focal_min(kernel=self.kernel_circle, iterations=morph_op_iters)
       elif morph_op == 'opening':
-        water_mask = water_mask.focal_min(kernel=ee.Kernel.square(radius=1), iterations=morph_op_iters).focal_max(kernel=ee.Kernel.circle(radius=1), iterations=morph_op_iters)
+        water_mask = water_mask.focal_min(kernel=self.kernel_square, iterations=morph_op_iters).focal_max(kernel=self.kernel_circle, iterations=morph_op_iters)
       elif morph_op == 'dilation':
-        water_mask = water_mask.focal_max(kernel=ee.Kernel.square(radius=1), iterations=morph_op_iters)
+        water_mask = water_mask.focal_max(kernel=self.kernel_square, iterations=morph_op_iters)
       elif morph_op == 'erosion':
-        water_mask = water_mask.focal_min(kernel=ee.Kernel.square(radius=1), iterations=morph_op_iters)
+        water_mask = water_mask.focal_min(kernel=self.kernel_square, iterations=morph_op_iters)
 
     # build image with mask
     return ee.Image(0).blend(ee.Image(abs(self.dummy)).updateMask(water_mask))
@@ -224,21 +293,33 @@ class Abyo:
 
 
   # extract image from collection
+  # dates availability and images ids are looked up locally (no GEE round-trips)
   def extract_image_from_collection(self, date):
-    collection = self.collection.filter(ee.Filter.date(date.strftime("%Y-%m-%d"), (date + td(days=1)).strftime("%Y-%m-%d")))
-    if int(collection.size().getInfo()) == 0:
-      collection = self.collection.filter(ee.Filter.date(date.strftime("%Y-%m-%d"), (date + td(days=2)).strftime("%Y-%m-%d")))
-      if int(collection.size().getInfo()) == 0:
-        return None
-    return self.apply_water_mask(ee.Image(collection.max()).set('system:id', collection.first().get('system:id').getInfo()), False)
+    image_id = self.get_image_id(date)
+    if image_id is None:
+      return None
+    days = 1 if date.strftime("%Y-%m-%d") in self.dates_timeseries_ids else 2
+    collection = self.collection.filter(ee.Filter.date(date.strftime("%Y-%m-%d"), (date + td(days=days)).strftime("%Y-%m-%d")))
+    return self.apply_water_mask(ee.Image(collection.max()).set('system:id', image_id), False)
     
 
+  # first image id of a date (or of the next day), from the local date-to-id map
+  def get_image_id(self, date):
+    image_id = self.dates_timeseries_ids.get(date.strftime("%Y-%m-%d"))
+    if image_id is None:
+      image_id = self.dates_timeseries_ids.get((date + td(days=1)).strftime("%Y-%m-%d"))
+    return image_id
+
+
   # extract image from yearly collection
+  # yearly collection has one image per year in years_list, so no size check is needed in GEE
   def extract_image_from_collection_yearly(self, year):
-    collection = self.collection_yearly.filter(ee.Filter.eq('year', int(year)))
-    if int(collection.size().getInfo()) == 0:
+    if int(year) not in self.years_list:
       return None
-    return self.apply_water_mask(ee.Image(collection.first()), False)
+    if not int(year) in self.images_yearly:
+      collection = self.collection_yearly.filter(ee.Filter.eq('year', int(year)))
+      self.images_yearly[int(year)] = self.apply_water_mask(ee.Image(collection.first()), False)
+    return self.images_yearly[int(year)]
 
 
   # split images into tiles
@@ -255,17 +336,13 @@ class Abyo:
       latitudes       = np.linspace(self.sample_lon_lat[0][1], self.sample_lon_lat[1][1], num=tiles+1)
       longitudes      = np.linspace(self.sample_lon_lat[0][0], self.sample_lon_lat[1][0], num=tiles+1)
 
-      # go through all latitudes and longitudes
-      geometries = []
-      for i, latitude in enumerate(latitudes[:-1]):
-        for j, longitude in enumerate(longitudes[:-1]):
-          x1 = [i,j]
-          x2 = [i+1,j+1]
-          geometry = gee.get_geometry_from_lat_lon(str(latitudes[x1[0]])+","+str(longitudes[x1[1]])+","+str(latitudes[x2[0]])+","+str(longitudes[x2[1]]))
-          geometries.append(geometry)
+      # tiles diagonal points (all latitudes and longitudes combinations)
+      x1, y1 = np.meshgrid(latitudes[:-1], longitudes[:-1], indexing='ij')
+      x2, y2 = np.meshgrid(latitudes[1:], longitudes[1:], indexing='ij')
+      bboxes = np.stack([x1.ravel(), y1.ravel(), x2.ravel(), y2.ravel()], axis=1).tolist()
 
       # return all created geometries
-      return geometries
+      return [gee.get_geometry_from_bbox(*bbox) for bbox in bboxes]
 
     else:
       
@@ -273,16 +350,21 @@ class Abyo:
       return [gee.get_geometry_from_lat_lon(self.lat_lon)]
 
 
-  # get cache files for datte
-  def get_cache_files(self, year: int):
-    prefix            = self.hash_string.encode()+str(str(self.date_start)+str(self.date_end)+str(self.date_start2)+str(self.date_end2)).encode()+self.lat_lon.encode()+self.sensor.encode()+str(self.morph_op).encode()+str(self.morph_op_iters).encode()+str(gee.indice_selected).encode()+str(gee.min_occurrence).encode()+str(self.shapefile_url).encode()
-    hash_image        = hashlib.md5(prefix+(str(year)+'original').encode())
-    hash_timeseries   = hashlib.md5(prefix+(str(self.years_list[0])+str(self.years_list[-1])).encode())
-    return [self.cache_path+'/'+hash_image.hexdigest(), self.cache_path+'/'+hash_timeseries.hexdigest()]
+  # get cache file for a given suffix
+  # (the parameters prefix is hashed once in constructor and only the suffix is hashed here)
+  def get_cache_file(self, suffix: str):
+    hash_file = self.hash_prefix.copy()
+    hash_file.update(suffix.encode())
+    return self.cache_path+'/'+hash_file.hexdigest()
+
+
+  # get cache files for datte (pixels), time series and sample statistics
+  def get_cache_files(self, year: int = None):
+    return [self.get_cache_file(suffix) for suffix in [str(year)+'original', str(self.years_list[0])+str(self.years_list[-1]), 'sample']]
 
 
   # process a timeseries
-  def process_timeseries_data(self, force_cache: bool = False):
+  def process_timeseries_data(self, force_cache: bool = False, cache_only: bool = False):
 
     # warning
     print()
@@ -294,6 +376,11 @@ class Abyo:
 
     # check timeseries is already on cache
     cache_files    = self.get_cache_files(year=dt.now().strftime("%Y"))
+
+    # cached results only can not be combined with cache reseting
+    if cache_only and (self.force_cache or force_cache):
+      raise Exception("Options 'cache_only' and 'force_cache' can not be used together!")
+
     try:
 
       # warning
@@ -310,50 +397,52 @@ class Abyo:
     # if do not exist, process normally and save it in the end
     except:
 
+      # user asked only for cached results
+      if cache_only:
+        raise Exception("Time series is not in cache! Run it once without 'cache_only' to build it.")
+
       # warning
       print("Error trying to get it from cache: either doesn't exist or is corrupted! Creating it again...")
 
       # process all years in time series
-      for year in self.years_list:
+      # years are independent and bound by GEE requests, so threads are used
+      results = joblib.Parallel(n_jobs=min(self.n_jobs, len(self.years_list)), backend='threading')(joblib.delayed(self.extract_year_pixels)(year) for year in self.years_list)
 
-        # extract pixels from image
-        # check if is good image (with pixels)
-        df_timeseries_ = self.extract_image_pixels(image=self.extract_image_from_collection_yearly(year=year), year=year)
-        if df_timeseries_.size > 0:
-          df_timeseries = self.merge_timeseries(df_list=[df_timeseries, df_timeseries_])
+      # get only good years (with pixels) and merge them once, sorted and indexed
+      df_list = [df_timeseries_ for df_timeseries_ in results if df_timeseries_.size > 0]
+      if df_list:
+        df_timeseries = self.merge_timeseries(df_list=df_list)
 
-      # get only good years
-      # fix dataframe index
-      if not df_timeseries is None:
-        df_timeseries['index'] = range(0,len(df_timeseries))
-
-        # save in cache
-        if self.cache_path:
-          joblib.dump(df_timeseries, cache_files[1])
+      # save in cache
+      if self.cache_path:
+        joblib.dump(df_timeseries, cache_files[1], compress=('lz4', 3))
 
     # correct columns types
     df_timeseries[['pixel','year']] = df_timeseries[['pixel','year']].astype('int64')
     df_timeseries[self.attributes+['lat','lon']] = df_timeseries[self.attributes+['lat','lon']].astype('float64')
 
-    # remove dummies
-    for attribute in [a for a in self.attributes if a != 'cloud']:
-      df_timeseries = df_timeseries[(df_timeseries[attribute]!=abs(self.dummy))]
+    # remove dummies (single mask over all attributes)
+    mask = np.all(df_timeseries[[a for a in self.attributes if a != 'cloud']].to_numpy() != abs(self.dummy), axis=1)
+    df_timeseries = df_timeseries.loc[mask].copy()
 
     # change cloud values
-    df_timeseries.loc[df_timeseries['cloud'] == abs(self.dummy), 'cloud'] = 0.0
+    df_timeseries['cloud'] = np.where(df_timeseries['cloud'].values == abs(self.dummy), 0.0, df_timeseries['cloud'].values)
 
     # remove duplicated values
     df_timeseries.drop_duplicates(subset=['pixel','year','lat','lon']+self.attributes, keep='last', inplace=True)
 
-    # add porcentage of occurrence and cloud
-    df_timeseries['pct_occurrence']   = (df_timeseries['occurrence']/(df_timeseries['occurrence']+df_timeseries['not_occurrence']))*100
-    df_timeseries['pct_cloud']        = (df_timeseries['cloud']/(df_timeseries['occurrence']+df_timeseries['not_occurrence']+df_timeseries['cloud']))*100
-    df_timeseries['instants']         = df_timeseries['occurrence']+df_timeseries['not_occurrence']+df_timeseries['cloud']
+    # downcast columns to the smallest types that fit them (yearly counters, label is negative when cloudy)
+    # coordinates stay float64 (float32 quantizes pixel steps unevenly and changes the saved coordinates)
+    df_timeseries = df_timeseries.astype({'year': 'uint16', 'pixel': 'uint32', 'occurrence': 'uint16', 'not_occurrence': 'uint16', 'cloud': 'uint16', 'label': 'int32'})
 
-    # convert to int
-    df_timeseries.fillna(0, inplace=True)
-    df_timeseries['pct_occurrence']   = df_timeseries['pct_occurrence'].astype(int)
-    df_timeseries['pct_cloud']        = df_timeseries['pct_cloud'].astype(int)
+    # add porcentage of occurrence and cloud (zero when there is no valid instant)
+    occurrence                        = df_timeseries['occurrence'].to_numpy(np.float64)
+    cloud                             = df_timeseries['cloud'].to_numpy(np.float64)
+    valid                             = occurrence+df_timeseries['not_occurrence'].to_numpy(np.float64)
+    instants                          = valid+cloud
+    df_timeseries['pct_occurrence']   = (np.divide(occurrence, valid, out=np.zeros_like(valid), where=valid>0)*100).astype('uint8')
+    df_timeseries['pct_cloud']        = (np.divide(cloud, instants, out=np.zeros_like(instants), where=instants>0)*100).astype('uint8')
+    df_timeseries['instants']         = instants.astype('uint16')
 
     # save modified dataframe to its original variable
     self.df_timeseries = df_timeseries[df_columns]
@@ -366,12 +455,16 @@ class Abyo:
     print("finished!")
 
 
-  # merge two or more timeseries
+  # merge two or more timeseries (at once, avoid calling it incrementally)
   def merge_timeseries(self, df_list: list):
-    df            = pd.concat(df_list, ignore_index=True, sort=False)
+    df            = pd.concat(df_list, ignore_index=True, sort=False, copy=False).sort_values(by=['year', 'pixel'])
     df['index']   = np.arange(start=0, stop=len(df), step=1, dtype=np.int64)
-    gc.collect()
-    return df.sort_values(by=['year', 'pixel'])
+    return df
+
+
+  # extract pixels from a single year
+  def extract_year_pixels(self, year: int):
+    return self.extract_image_pixels(image=self.extract_image_from_collection_yearly(year=year), year=year)
 
 
   # extract image's coordinates and pixels values
@@ -407,18 +500,16 @@ class Abyo:
       # image exists
       try:
 
-        # check if image has less cloud than the cloud threshold
-        clip = self.clip_image(self.extract_image_from_collection_yearly(year=year))
-        
-        # go through each tile
-        lons_lats_attributes = np.array([], dtype=np.float64).reshape(0, len(self.attributes)+2)
-        for i, geometry in enumerate(self.splitted_geometry):
-          print("Extracting geometry ("+str(len(lons_lats_attributes))+") "+str(i+1)+" of "+str(len(self.splitted_geometry))+"...")
-          geometry_lons_lats_attributes = gee.extract_latitude_longitude_pixel(image=clip, geometry=geometry, bands=[a+"_water" for a in self.attributes], scale=self.sensor_params['scale'])
-          lons_lats_attributes = np.concatenate((lons_lats_attributes, geometry_lons_lats_attributes))
+        # clip the image once to the study area grid (each tile is selected by reduceRegion, on the same pixels grid)
+        clip = self.clip_image(image)
+
+        # go through each tile (in parallel, keeping tiles order)
+        print("Extracting "+str(len(self.splitted_geometry))+" geometries from year "+str(year)+"...")
+        tiles_lons_lats_attributes = joblib.Parallel(n_jobs=min(self.n_jobs, len(self.splitted_geometry)), backend='threading')(joblib.delayed(gee.extract_latitude_longitude_pixel)(image=clip, geometry=geometry, bands=[a+"_water" for a in self.attributes], scale=self.sensor_params['scale']) for geometry in self.splitted_geometry)
+        lons_lats_attributes = np.concatenate(tiles_lons_lats_attributes, axis=0) if tiles_lons_lats_attributes else np.empty((0, len(self.attributes)+2), dtype=np.float64)
 
         # save in cache
-        joblib.dump(lons_lats_attributes, cache_files[0])
+        joblib.dump(lons_lats_attributes, cache_files[0], compress=('lz4', 3))
 
       # error in the extraction process
       except:
@@ -436,13 +527,13 @@ class Abyo:
       if lons_lats_attributes is None:
         raise Exception()
 
-      # build dataframe
-      extra_attributes        = np.array(list(zip([0]*len(lons_lats_attributes),[0]*len(lons_lats_attributes),[year]*len(lons_lats_attributes))))
-      df_timeseries           = pd.DataFrame(data=np.concatenate((extra_attributes, lons_lats_attributes), axis=1), columns=self.df_columns).sort_values(['lat','lon'])
-      df_timeseries['pixel']  = range(0,len(df_timeseries))
+      # build dataframe (column by column, keeping integer types)
+      total                   = len(lons_lats_attributes)
+      df_timeseries           = pd.DataFrame({'pixel': np.zeros(total, dtype=np.int64), 'index': np.zeros(total, dtype=np.int64), 'year': np.full(total, int(year), dtype=np.int64), 'lat': lons_lats_attributes[:,0], 'lon': lons_lats_attributes[:,1], **{attribute: lons_lats_attributes[:,i+2] for i, attribute in enumerate(self.attributes)}}, columns=self.df_columns).sort_values(['lat','lon'])
+      df_timeseries['pixel']  = np.arange(total, dtype=np.int64)
 
       # gabagge collect
-      del lons_lats_attributes, extra_attributes
+      del lons_lats_attributes
       gc.collect()
 
       # return all pixels in an three pandas format
@@ -474,17 +565,34 @@ class Abyo:
     print()
     print("Creating occurrences plot to folder '"+folder+"'...")
 
-    # check if folder exists
-    if not os.path.exists(folder):
-      os.mkdir(folder)
+    # create folder (if it does not exist)
+    os.makedirs(folder, exist_ok=True)
     
-    # years list
-    years_list  = df.groupby('year')['year'].agg('mean').values
+    # pixels grid (shared by all years and plots)
+    grid        = self.get_pixels_grid(df=df)
+
+    # split data by year once (shared by both plots)
+    groups      = {year: df_year for year, df_year in df.groupby('year', sort=True)}
 
     # build date string
+    years_list  = list(groups.keys())
     str_date    = str(int(min(years_list))) + ' to ' + str(int(max(years_list)))
 
+    # Yearly Occurrences
+    self.save_occurrences_figure(groups=groups, column='pct_occurrence', grid=grid, cmap='jet', title='% Algal Bloom Yearly Occurrences  ('+str_date+', '+str(gee.indice_selected).upper()+')', path=folder+'/occurrences.png')
+
+    # Yearly Cloud Occurrences
+    self.save_occurrences_figure(groups=groups, column='pct_cloud', grid=grid, cmap='Greys', title='% Algal Bloom Yearly Cloud Occurrences  ('+str_date+')', path=folder+'/occurrences_clouds.png')
+
+    # warning
+    print("finished!")
+
+
+  # save a figure of a column rasterized yearly (one subplot per year)
+  def save_occurrences_figure(self, groups: dict, column: str, grid: list, cmap: str, title: str, path: str):
+
     # number of columns
+    years_list  = list(groups.keys())
     columns     = 6 if len(years_list)>=6 else len(years_list)
     rows        = math.ceil(len(years_list)/columns)
     fig_height  = 16/columns
@@ -496,36 +604,24 @@ class Abyo:
     # colorbar tixks
     colorbar_ticks_max          = 100
     colorbar_ticks              = np.linspace(0, colorbar_ticks_max if colorbar_ticks_max > 1 else 2, num=5, dtype=int)
-    colorbar_ticks_labels       = [str(l) for l in colorbar_ticks]
-    colorbar_ticks_labels[-1]   = str(colorbar_ticks_labels[-1])
-
-    ###############
-    ### Yearly Occurrences
 
     # create the plot
     fig = plt.figure(figsize=(20,rows*fig_height), dpi=300)
-    fig.suptitle('% Algal Bloom Yearly Occurrences  ('+str_date+', '+str(gee.indice_selected).upper()+')', fontsize=14, y=1.04)
+    fig.suptitle(title, fontsize=14, y=1.04)
     fig.autofmt_xdate()
     plt.rc('xtick',labelsize=6)
     plt.rc('ytick',labelsize=6)
 
-    # marker size
-    multiplier  = math.ceil(self.sensor_params['scale']/100)
-    multiplier  = multiplier if multiplier >= 1 else 1
-    markersize  = (72./fig.dpi)*multiplier
-
     # go through each year
     images = []
     for i, year in enumerate(years_list):
 
-      # filter year data
-      df_year = df[(df['year'] == year)]
-
       # add plot
       ax = fig.add_subplot(rows,columns,i+1)
       ax.grid(True, linestyle='dashed', color='#909090', linewidth=0.1)
       ax.title.set_text(str(int(year)))
-      s = ax.scatter(df_year['lat'], df_year['lon'], s=markersize, c=df_year['pct_occurrence'], cmap=plt.get_cmap('jet'))
+      raster, extent = self.rasterize_pixels(df=groups[year], column=column, grid=grid)
+      s = ax.imshow(raster, origin='lower', extent=extent, aspect='auto', interpolation='nearest', cmap=plt.get_cmap(cmap))
       s.set_clim(colorbar_ticks[0], colorbar_ticks[-1])
       ax.margins(x=0,y=0)
       ax.set_xticks(xticks)
@@ -538,53 +634,43 @@ class Abyo:
     cbar = fig.colorbar(images[-1], cax=fig.add_axes([0.6, -0.05, 0.39, 0.05]), ticks=colorbar_ticks, orientation='horizontal')
     cbar.set_label("% of occurrence")
 
-    # save it to file
+    # save it to file and release its memory
     plt.subplots_adjust(wspace=0.4, hspace=0.4)
     plt.tight_layout()
-    fig.savefig(folder+'/occurrences.png', bbox_inches='tight')
-
-
-    ###############
-    ### Yearly Cloud Occurrences
-
-    # create the plot
-    fig = plt.figure(figsize=(20,rows*fig_height), dpi=300)
-    fig.suptitle('% Algal Bloom Yearly Cloud Occurrences  ('+str_date+')', fontsize=14, y=1.04)
-    fig.autofmt_xdate()
-    plt.rc('xtick',labelsize=6)
-    plt.rc('ytick',labelsize=6)
-
-    # go through each year
-    images = []
-    for i, year in enumerate(years_list):
-
-      # filter year data
-      df_year = df[(df['year'] == year)]
-
-      # add plot
-      ax = fig.add_subplot(rows,columns,i+1)
-      ax.grid(True, linestyle='dashed', color='#909090', linewidth=0.1)
-      ax.title.set_text(str(int(year)))
-      s = ax.scatter(df_year['lat'], df_year['lon'], s=markersize, c=df_year['pct_cloud'], cmap=plt.get_cmap('Greys'))
-      s.set_clim(colorbar_ticks[0], colorbar_ticks[-1])
-      ax.margins(x=0,y=0)
-      ax.set_xticks(xticks)
-      ax.set_yticks(yticks)
-      ax.xaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-      ax.yaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-      images.append(s)
-
-    # figure add cmap
-    cbar = fig.colorbar(images[-1], cax=fig.add_axes([0.6, -0.05, 0.39, 0.05]), ticks=colorbar_ticks, orientation='horizontal')
-    cbar.set_label("% of occurrence")
-
-    # save it to file
-    plt.subplots_adjust(wspace=0.4, hspace=0.4)
-    plt.tight_layout()
-    fig.savefig(folder+'/occurrences_clouds.png', bbox_inches='tight')
-
-    # warning
-    print("finished!")
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+
+
+  # regular grid of the sampled pixels, as (origin, step, size) for x and y
+  # origin and step come from the sampled coordinates (GEE may coarsen the scale with bestEffort)
+  # columns 'lat' and 'lon' hold, respectively, pixels longitude (x) and latitude (y)
+  def get_pixels_grid(self, df: pd.DataFrame):
+    grid      = []
+    nominal   = self.sensor_params['scale']/111319.49
+    for column in ['lat', 'lon']:
+
+      # distinct grid positions (merging float rounding jitter)
+      values  = np.unique(df[column].to_numpy(np.float64))
+      values  = values[np.concatenate(([True], np.diff(values) > nominal/2))]
+      if len(values) < 2:
+        grid.append((values[0], nominal, 1))
+        continue
+
+      # count pixel intervals between positions (gaps of missing pixels span several) and derive the step from the whole span
+      steps     = np.diff(values)
+      intervals = int(np.rint(steps/np.median(steps)).sum())
+      grid.append((values[0], (values[-1]-values[0])/intervals, intervals+1))
+    return grid
+
+
+  # rasterize pixels values into a regular grid
+  def rasterize_pixels(self, df: pd.DataFrame, column: str, grid: list):
+    (x0, dx, nx), (y0, dy, ny) = grid
+    rows    = np.clip(np.rint((df['lon'].to_numpy(np.float64)-y0)/dy).astype(int), 0, ny-1)
+    cols    = np.clip(np.rint((df['lat'].to_numpy(np.float64)-x0)/dx).astype(int), 0, nx-1)
+    raster  = np.full((ny, nx), np.nan, dtype=np.float32)
+    raster[rows, cols] = df[column].to_numpy()
+    return raster, [x0-dx/2, x0+(nx-0.5)*dx, y0-dy/2, y0+(ny-0.5)*dy]
 
 
   # save occurrences geojson
@@ -598,13 +684,16 @@ class Abyo:
     df = df.fillna(0)
 
     # # save occurrences data
-    features = []
-    for index, row in df.iterrows():
-      features.append(geojson.Feature(geometry=geojson.Point((row['lat'], row['lon'])), properties={"year": int(row['year']), "pct_occurrence": int(row['pct_occurrence']), "pct_cloud": int(row['pct_cloud']), "instants": int(row['instants'])}))
-    fc = geojson.FeatureCollection(features)
-    f = open(path,"w")
-    geojson.dump(fc, f)
-    f.close()
+    # columns are converted at once to python types (no per-row conversion, coordinates with 6 decimals)
+    lat, lon = np.round(df['lat'].to_numpy(np.float64), 6).tolist(), np.round(df['lon'].to_numpy(np.float64), 6).tolist()
+    year, pct_occurrence, pct_cloud, instants = [df[c].to_numpy(np.int64).tolist() for c in ['year', 'pct_occurrence', 'pct_cloud', 'instants']]
+
+    # features are streamed to file one by one (the feature collection is never held in memory)
+    with open(path,"w") as f:
+      f.write('{"type": "FeatureCollection", "features": [')
+      for i, (a, b, y, o, c, n) in enumerate(zip(lat, lon, year, pct_occurrence, pct_cloud, instants)):
+        f.write((', ' if i > 0 else '')+json.dumps({"type": "Feature", "geometry": {"type": "Point", "coordinates": [a, b]}, "properties": {"year": y, "pct_occurrence": o, "pct_cloud": c, "instants": n}}))
+      f.write(']}')
 
 
   # save a collection in tiff (zip) to folder (time series)
@@ -617,51 +706,59 @@ class Abyo:
     print()
     print("Saving image collection in tiff to Folder '"+str(folder)+"' (first try, based on image size) or to your Google Drive at folder '"+str(folderName)+"'...")
 
-    # check if folder exists
-    if not os.path.exists(folder):
-      os.mkdir(folder)
+    # create folder (if it does not exist)
+    os.makedirs(folder, exist_ok=True)
 
     # select image attributes to be exported
     attributes = ['occurrence_water', 'not_occurrence_water', 'cloud_water']
 
-    # go through all the collection
-    for date in self.dates_timeseries_interval:
-
-      # get image
-      image = self.clip_image(self.extract_image_from_collection(date=date), geometry=self.geometry)
-
-      # check if its landsat merge
-      if rgb:
-        bands = [self.sensor_params['red'], self.sensor_params['green'], self.sensor_params['blue']]+attributes
-        if self.sensor_params["sensor"] == "landsat578":
-          sensor = image.get(self.sensor_params["property_id"]).getInfo()
-          if 'LT05' in sensor:
-            bands = [gee.get_sensor_params("landsat5")['red'], gee.get_sensor_params("landsat5")['green'], gee.get_sensor_params("landsat5")['blue']]+attributes
-          elif 'LE07' in sensor:
-            bands = [gee.get_sensor_params("landsat7")['red'], gee.get_sensor_params("landsat7")['green'], gee.get_sensor_params("landsat7")['blue']]+attributes
-          elif 'LC08' in sensor:
-            bands = [gee.get_sensor_params("landsat")['red'], gee.get_sensor_params("landsat")['green'], gee.get_sensor_params("landsat")['blue']]+attributes
-      else:
-        bands = attributes
+    # go through all the collection (in parallel, bound by GEE requests)
+    joblib.Parallel(n_jobs=self.n_jobs_download, backend='threading')(joblib.delayed(self.save_date_tiff)(date=date, folder=folder, folderName=folderName, attributes=attributes, rgb=rgb) for date in self.dates_timeseries_interval)
 
-      # First try, save in local folder
-      try:
-        print("Trying to save "+date.strftime("%Y-%m-%d")+" GeoTIFF to local folder...")
+    # warning
+    print("finished!")
+
+
+  # save a single date of the collection in tiff (zip) to folder
+  def save_date_tiff(self, date: dt, folder: str, folderName: str, attributes: list, rgb: bool = False):
+
+    # get image
+    image = self.clip_image(self.extract_image_from_collection(date=date), geometry=self.geometry)
+
+    # check if its landsat merge
+    if rgb:
+      bands = [self.sensor_params['red'], self.sensor_params['green'], self.sensor_params['blue']]+attributes
+      if self.sensor_params["sensor"] == "landsat578":
+        sensor = self.get_image_id(date) or ""
+        for prefix, landsat_bands in self.landsat_rgb_bands.items():
+          if prefix in sensor:
+            bands = landsat_bands+attributes
+            break
+    else:
+      bands = attributes
+
+    # First try, save in local folder
+    try:
+      print("Trying to save "+date.strftime("%Y-%m-%d")+" GeoTIFF to local folder...")
+
+      # pixels computed straight into a multiband GeoTIFF (bands in the same order as selected, all of them with one data type)
+      if self.fetch_mode == "computePixels":
+        self.save_computed_pixels(image=image.select(bands).toFloat(), path=folder+'/'+date.strftime("%Y-%m-%d")+'.tif')
+
+      # signed download url of a zip (one GeoTIFF per band)
+      else:
+        gee.throttle()
         image_download_url = image.select(bands).getDownloadUrl({"name": date.strftime("%Y-%m-%d"), "region":self.geometry, "filePerBand": True})
-        open(folder+'/'+date.strftime("%Y-%m-%d")+'.zip', 'wb').write(requests.get(image_download_url, allow_redirects=True).content)
-        print("finished!")
+        self.download_file(url=image_download_url, path=folder+'/'+date.strftime("%Y-%m-%d")+'.zip')
+      print("finished!")
 
-      # Second try, save in Google Drive
-      except:
-        print("Error! It was not possible to save GeoTIFF localy. Trying to save it in Google Drive...")
-        for band in bands:
-          task = ee.batch.Export.image.toDrive(image=image.select(band), folder=folderName, description=date.strftime("%Y-%m-%d")+"_"+str(band), region=self.geometry)
-          task.start()
-          print(task.status())
+    # Second try, save in Google Drive
+    except Exception as e:
+      print("Error! It was not possible to save GeoTIFF localy ("+str(e)+"). Trying to save it in Google Drive...")
+      task = ee.batch.Export.image.toDrive(image=image.select(bands).toFloat(), folder=folderName, description=date.strftime("%Y-%m-%d"), region=self.geometry)
+      task.start()
+      print(task.status())
 
-    # warning
-    print("finished!")
-  
 
   # save a collection in png to folder (time series)
   def save_collection_png(self, folder: str, options: dict = {'min':0, 'max': 3000}):
@@ -670,40 +767,67 @@ class Abyo:
     print()
     print("Saving image collection to folder '"+folder+"'...")
 
-    # check if folder exists
-    if not os.path.exists(folder):
-      os.mkdir(folder)
-
-    # go through all the collection
-    for date in self.dates_timeseries_interval:
+    # create folder (if it does not exist)
+    os.makedirs(folder, exist_ok=True)
 
-      # get sensor name
-      image_collection = self.collection.filter(ee.Filter.date(date.strftime("%Y-%m-%d"), (date + td(days=1)).strftime("%Y-%m-%d")))
-
-      # check if its landsat merge
-      bands = None
-      if self.sensor_params["sensor"] == "landsat578":
-        sensor = image_collection.first().get(self.sensor_params["property_id"]).getInfo()
-        if 'LT05' in sensor:
-          bands = [gee.get_sensor_params("landsat5")['red'], gee.get_sensor_params("landsat5")['green'], gee.get_sensor_params("landsat5")['blue']]
-        elif 'LE07' in sensor:
-          bands = [gee.get_sensor_params("landsat7")['red'], gee.get_sensor_params("landsat7")['green'], gee.get_sensor_params("landsat7")['blue']]
-        elif 'LC08' in sensor:
-          bands = [gee.get_sensor_params("landsat")['red'], gee.get_sensor_params("landsat")['green'], gee.get_sensor_params("landsat")['blue']]
-
-      # check if folder exists
-      path_image = folder+'/'+date.strftime("%Y-%m-%d")
-      if not os.path.exists(path_image):
-        os.mkdir(path_image)
-
-      # save geometries in folder
-      for i, geometry in enumerate(self.splitted_geometry):
-        self.save_image(image=self.clip_image(self.extract_image_from_collection(date=date), geometry=geometry), path=path_image+"/"+date.strftime("%Y-%m-%d")+"_"+str(i)+".png", bands=bands, options=options)
+    # go through all the collection (in parallel, bound by GEE requests)
+    joblib.Parallel(n_jobs=self.n_jobs_download, backend='threading')(joblib.delayed(self.save_date_png)(date=date, folder=folder, options=options) for date in self.dates_timeseries_interval)
     
     # warning
     print("finished!")
 
 
+  # save a single date of the collection in png to folder
+  def save_date_png(self, date: dt, folder: str, options: dict = {'min':0, 'max': 3000}):
+
+    # check if its landsat merge (sensor name from the image id)
+    bands = None
+    if self.sensor_params["sensor"] == "landsat578":
+      sensor = self.get_image_id(date) or ""
+      for prefix, landsat_bands in self.landsat_rgb_bands.items():
+        if prefix in sensor:
+          bands = landsat_bands
+          break
+
+    # create folder (if it does not exist)
+    path_image = folder+'/'+date.strftime("%Y-%m-%d")
+    os.makedirs(path_image, exist_ok=True)
+
+    # save geometries in folder
+    image = self.extract_image_from_collection(date=date)
+    for i, geometry in enumerate(self.splitted_geometry):
+      self.save_image(image=self.clip_image(image, geometry=geometry), path=path_image+"/"+date.strftime("%Y-%m-%d")+"_"+str(i)+".png", bands=bands, options=options)
+
+
+  # compute image pixels over the study area grid and save them as GeoTIFF (no intermediate download url)
+  def save_computed_pixels(self, image: ee.Image, path: str):
+
+    # study area grid in degrees, with pixel size approximated from the sensor scale
+    x1, y1, x2, y2  = [float(c) for c in self.lat_lon.split(",")]
+    step            = self.sensor_params['scale']/111320.0
+    grid            = {
+                        'dimensions': {'width': int(math.ceil(abs(x2-x1)/step)), 'height': int(math.ceil(abs(y2-y1)/step))},
+                        'affineTransform': {'scaleX': step, 'shearX': 0, 'translateX': min(x1, x2), 'shearY': 0, 'scaleY': -step, 'translateY': max(y1, y2)},
+                        'crsCode': 'EPSG:4326'
+                      }
+
+    # request pixels and save them
+    gee.throttle()
+    pixels = ee.data.computePixels({'expression': image, 'fileFormat': 'GEO_TIFF', 'grid': grid})
+    with open(path, 'wb') as f:
+      f.write(pixels)
+
+
+  # download a file to disk (streamed in chunks, failing on http errors)
+  def download_file(self, url: str, path: str):
+    gee.throttle()
+    with self.http.get(url, allow_redirects=True, stream=True, timeout=300) as response:
+      response.raise_for_status()
+      with open(path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=1024*1024):
+          f.write(chunk)
+
+
   # save a image to file
   def save_image(self, image: ee.Image, path: str, bands: list = None, options: dict = {'min':0, 'max': 3000}):
     
@@ -715,9 +839,9 @@ class Abyo:
     if not bands:
       bands = [self.sensor_params['red'], self.sensor_params['green'], self.sensor_params['blue']]
 
-    # extract imagem from GEE using getThumbUrl function and saving it
-    imageIO = PIL.Image.open(BytesIO(requests.get(image.select(bands).getThumbUrl(options), timeout=60).content))
-    imageIO.save(path)
+    # extract imagem from GEE using getThumbUrl function and stream it to file (PNG requested explicitly, GEE defaults to JPEG on opaque images)
+    gee.throttle()
+    self.download_file(url=image.select(bands).getThumbUrl(dict(options, format='png')), path=path)
     
     # warning
     print("finished!")
@@ -733,8 +857,11 @@ class Abyo:
     # drop unused columns
     df = df.drop(['label'], axis=1)
 
-    # saving dataset to file
-    df.to_csv(r''+path, index=False)
+    # saving dataset to file (columnar binary when a parquet path is given, requires pyarrow)
+    if path.endswith('.parquet'):
+      df.to_parquet(path, compression='snappy', index=False)
+    else:
+      df.to_csv(r''+path, index=False)
     
     # warning
     print("finished!")
\ No newline at end of file
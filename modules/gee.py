@@ -11,6 +11,9 @@ import ee
 import numpy as np
 import traceback
 import sys
+import functools
+import threading
+import time
 from datetime import datetime as dt
 from datetime import timedelta as td
 
@@ -23,7 +26,33 @@ indice_selected     = "mndwi,ndvi,sabi,fai,slope"
 indice_thresholds   = {'mndwi': 0.0, 'ndvi': -0.15, 'sabi': -0.10, 'fai': -0.004, 'slope': -0.05}
 min_occurrence      = 5
 
-# Return the parameters of each sensor
+# Earth Engine endpoint tuned for many small concurrent requests
+highvolume_url      = "https://earthengine-highvolume.googleapis.com"
+
+# Maximum requests per second sent to GEE by all threads (None disables it)
+max_requests_per_second = None
+throttle_lock       = threading.Lock()
+throttle_next       = 0.0
+
+# Wait for a request slot, spacing requests evenly to stay below the quota (thread-safe)
+def throttle():
+  global throttle_next
+  if not max_requests_per_second:
+    return
+  with throttle_lock:
+    now           = time.monotonic()
+    wait          = throttle_next - now
+    throttle_next = max(now, throttle_next) + 1.0/max_requests_per_second
+  if wait > 0:
+    time.sleep(wait)
+
+# Request a GEE object to the client, respecting the requests rate
+def get_info(obj):
+  throttle()
+  return obj.getInfo()
+
+# Return the parameters of each sensor (static, so memoized)
+@functools.lru_cache(maxsize=None)
 def get_sensor_params(sensor: str):
 
   # COPERNICUS/S2_SR
@@ -146,13 +175,13 @@ def extract_latitude_longitude_pixel(image: ee.Image, geometry: ee.Geometry, ban
   # add bands
   band_values = []
   for band in bands:
-    band_values.append(np.array(ee.List(coordinates.get(band)).getInfo(), dtype=np.float64))
+    band_values.append(np.array(get_info(ee.List(coordinates.get(band))), dtype=np.float64))
 
   # build results
   band_values = np.array(band_values)
   result      = np.zeros(shape=(2+band_values.shape[0], band_values.shape[1]))
-  result[0]   = np.array(ee.List(coordinates.get('longitude')).getInfo(), dtype=np.float64)
-  result[1]   = np.array(ee.List(coordinates.get('latitude')).getInfo(), dtype=np.float64)
+  result[0]   = np.array(get_info(ee.List(coordinates.get('longitude'))), dtype=np.float64)
+  result[1]   = np.array(get_info(ee.List(coordinates.get('latitude'))), dtype=np.float64)
   for i, band_value in enumerate(band_values):
     result[i+2] = band_value
 
@@ -381,14 +410,22 @@ def get_image_min_max(image: ee.Image, geometry: ee.Geometry, scale: int = None,
   if scale is None:
     scale = image.projection().nominalScale()
   image = image.addBands(ee.Image.pixelLonLat())
-  return image.reduceRegion(reducer=ee.Reducer.min(), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale).getInfo(), image.reduceRegion(reducer=ee.Reducer.max(), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale).getInfo()
+  return get_info(image.reduceRegion(reducer=ee.Reducer.min(), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale)), get_info(image.reduceRegion(reducer=ee.Reducer.max(), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale))
 
 
 # Get image counters
 def get_image_counters(image: ee.Image, geometry: ee.Geometry, scale: int = None, tile_scale: int = 16):
   if scale is None:
     scale = image.projection().nominalScale()
-  return image.reduceRegion(reducer=ee.Reducer.count(), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale).getInfo()
+  return get_info(image.reduceRegion(reducer=ee.Reducer.count(), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale))
+
+
+# Get image counters, min and max values (single request)
+def get_image_counters_min_max(image: ee.Image, geometry: ee.Geometry, scale: int = None, tile_scale: int = 16):
+  if scale is None:
+    scale = image.projection().nominalScale()
+  image = image.addBands(ee.Image.pixelLonLat())
+  return get_info(image.reduceRegion(reducer=ee.Reducer.count().combine(ee.Reducer.minMax(), sharedInputs=True), geometry=geometry, scale=scale, bestEffort=True, tileScale=tile_scale))
 
 
 # Get geometry from diagonal points
@@ -397,13 +434,20 @@ def get_geometry_from_lat_lon(lat_lon: str):
   # Selection of coordinates (colon, lat and lon separated by comma, all together) and dates by the user (two dates, beginning and end, separated by commas)
   x1,y1,x2,y2 = lat_lon.split(",")
 
+  # return the geometry
+  return get_geometry_from_bbox(float(x1), float(y1), float(x2), float(y2))
+
+
+# Get geometry from diagonal points (numeric coordinates)
+def get_geometry_from_bbox(x1: float, y1: float, x2: float, y2: float):
+
   # Assemble Geometry on Google Earth Engine
   geometry = ee.Geometry.Polygon(
-        [[[float(x1),float(y2)],
-          [float(x2),float(y2)],
-          [float(x2),float(y1)],
-          [float(x1),float(y1)],
-          [float(x1),float(y2)]]])
+        [[[x1,y2],
+          [x2,y2],
+          [x2,y1],
+          [x1,y1],
+          [x1,y2]]])
 
   # return the geometry
   return geometry
\ No newline at end of file
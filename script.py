@@ -13,11 +13,8 @@ version = "V8"
 
 # ### Module imports
 
-# Main
-import ee
-import pandas as pd
+# Main (light modules only, heavy ones are imported after arguments validation)
 import math
-import requests
 import time
 import warnings
 import os
@@ -25,14 +22,14 @@ import sys
 import argparse
 import logging
 import traceback
+import concurrent.futures
+import json
+import subprocess
 
 # Sub
 from datetime import datetime as dt
 from datetime import timedelta
 
-# Extras modules
-from modules import misc, gee, abyo
-
 
 # ### Script args parsing
 
@@ -62,99 +59,201 @@ parser.add_argument('--shapefile', dest='shapefile', action='store',
                    help="Use a shapefile to clip a region of interest")
 parser.add_argument('--force_cache', dest='force_cache', action='store_true',
                    help="Force cache reseting to prevent image errors")
+parser.add_argument('--n_jobs', dest='n_jobs', type=int, action='store', default=8,
+                   help="Number of parallel workers used on GEE requests (years and tiles)")
+parser.add_argument('--parquet', dest='parquet', action='store_true',
+                   help="Save time series as Parquet (requires pyarrow) instead of CSV")
+parser.add_argument('--max_rps', dest='max_rps', type=float, action='store', default=90,
+                   help="Maximum requests per second sent to GEE by all workers (0 disables the limit)")
+parser.add_argument('--fetch', dest='fetch', action='store', default="getDownloadUrl", choices=["getDownloadUrl", "computePixels"],
+                   help="Define how GeoTIFFs are fetched from GEE (signed download url or computePixels)")
+parser.add_argument('--plot_only', dest='plot_only', action='store_true',
+                   help="Skip pixels extraction and only save results (plots, dataset and geojson) of a time series already in cache (GEE is still initialized for the collection statistics)")
+parser.add_argument('--no_highvolume', dest='highvolume', action='store_false',
+                   help="Use the default Earth Engine endpoint instead of the high-volume one")
 
 # parsing arguments
 args = parser.parse_args()
 
+# validate arguments before any GEE request (fail fast, exiting with the usage message)
+def validate(args):
+
+  # study area
+  try:
+    if len([float(c) for c in args.lat_lon.split(",")]) != 4:
+      raise ValueError()
+  except ValueError:
+    parser.error("--lat_lon must have 4 comma separated numbers, got '"+str(args.lat_lon)+"'")
+
+  # dates format and order
+  try:
+    dates = [dt.strptime(d, "%Y-%m-%d") if not d is None else None for d in [args.date_start, args.date_end, args.date_start2, args.date_end2]]
+  except ValueError as e:
+    parser.error("dates must be in the format YYYY-MM-DD ("+str(e)+")")
+  if dates[0] >= dates[1]:
+    parser.error("--date_start must be before --date_end")
+  if (dates[2] is None) != (dates[3] is None):
+    parser.error("--date_start2 and --date_end2 must be used together")
+  if not dates[2] is None and dates[2] >= dates[3]:
+    parser.error("--date_start2 must be before --date_end2")
+
+  # minimum occurrence (indices names are checked once gee module is loaded)
+  indices = args.indice.split(",")
+  if args.min_occurrence < 1 or args.min_occurrence > len(indices):
+    parser.error("--min_occurrence must be between 1 and the number of indices ("+str(len(indices))+")")
+
+  # cached results only can not be combined with cache reseting
+  if args.plot_only and args.force_cache:
+    parser.error("--plot_only cannot be used with --force_cache")
+
+  # workers and requests rate
+  if args.n_jobs < 1:
+    parser.error("--n_jobs must be at least 1")
+  if args.max_rps < 0:
+    parser.error("--max_rps must not be negative")
+
+  # parsed dates
+  return dates
+
+# parsing dates (once, while validating)
+date_start, date_end, date_start2, date_end2 = validate(args)
+
+
+# ### Heavy module imports
+
+# Main
+import ee
+import pandas as pd
+import requests
+
+# Plots are only saved to files (non-interactive backend, safe outside the main thread)
+import matplotlib
+matplotlib.use('Agg')
+
+# Extras modules
+from modules import misc, gee, abyo
+
+# indices names
+unknown = [i for i in args.indice.split(",") if not i in gee.indice_thresholds]
+if unknown:
+  parser.error("unknown indices "+str(unknown)+", use: "+",".join(gee.indice_thresholds.keys()))
+
 
 
 
 # ### Start
 
-try:
+# script messages (buffered by the logging module, with timestamps)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+# Start script time counter
+start_time = time.perf_counter()
 
-  # Start script time counter
-  start_time = time.time()
+try:
 
-  # Google Earth Engine API initialization
-  ee.Initialize()
+  # Google Earth Engine API initialization (high-volume endpoint, unless disabled)
+  if args.highvolume:
+    ee.Initialize(opt_url=gee.highvolume_url)
+  else:
+    ee.Initialize()
 
 
 
   # ### Working directory
 
+  # Script path
+  folderBase = os.path.dirname(os.path.realpath(__file__))
+
   # Data path
-  folderRoot = os.path.dirname(os.path.realpath(__file__))+'/data'
-  if not os.path.exists(folderRoot):
-    os.mkdir(folderRoot)
+  folderRoot = folderBase+'/data'
+  os.makedirs(folderRoot, exist_ok=True)
 
   # Images path
-  folderCache = os.path.dirname(os.path.realpath(__file__))+'/cache'
-  if not os.path.exists(folderCache):
-    os.mkdir(folderCache)
+  folderCache = folderBase+'/cache'
+  os.makedirs(folderCache, exist_ok=True)
 
 
   
   # ### ABYO execution
 
+  # run parameters used in folder and files names
+  name_dates = 'dstart='+str(args.date_start)+',dend='+str(args.date_end)+',dstart2='+str(args.date_start2)+',dend2='+str(args.date_end2)
+  name_moc   = 'moc='+str(args.min_occurrence)
+
   # folder to save results from algorithm at
-  folder = folderRoot+'/'+dt.now().strftime("%Y%m%d_%H%M%S")+'[v='+str(version)+'-'+str(args.name)+',dstart='+str(args.date_start)+',dend='+str(args.date_end)+',dstart2='+str(args.date_start2)+',dend2='+str(args.date_end2)+',i='+str(args.indice)+',moc='+str(args.min_occurrence)+']'
-  if not os.path.exists(folder):
-    os.mkdir(folder)
+  folder = folderRoot+'/'+dt.now().strftime("%Y%m%d_%H%M%S")+'[v='+str(version)+'-'+str(args.name)+','+name_dates+',i='+str(args.indice)+','+name_moc+']'
+  os.makedirs(folder, exist_ok=True)
 
   # create algorithm
   abyo = abyo.Abyo(lat_lon=args.lat_lon,
-                   date_start=dt.strptime(args.date_start, "%Y-%m-%d"),
-                   date_end=dt.strptime(args.date_end, "%Y-%m-%d"),
-                   date_start2=dt.strptime(args.date_start2, "%Y-%m-%d") if not args.date_start2 is None else None,
-                   date_end2=dt.strptime(args.date_end2, "%Y-%m-%d") if not args.date_end2 is None else None,
+                   date_start=date_start,
+                   date_end=date_end,
+                   date_start2=date_start2,
+                   date_end2=date_end2,
                    sensor=args.sensor,
                    cache_path=folderCache, 
                    force_cache=args.force_cache,
                    indice=args.indice,
                    min_occurrence=args.min_occurrence,
-                   shapefile=args.shapefile)
+                   shapefile=args.shapefile,
+                   n_jobs=args.n_jobs,
+                   max_rps=args.max_rps,
+                   fetch_mode=args.fetch)
+
+  # save run manifest (what was computed, with which code and cache key)
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=folderBase, capture_output=True, text=True).stdout.strip() or None
+  except OSError:
+    commit = None
+  with open(folder+'/manifest.json', 'w') as f:
+    json.dump({'version': version, 'commit': commit, 'args': vars(args), 'ts': dt.utcnow().isoformat(), 'endpoint': gee.highvolume_url if args.highvolume else 'default', 'cache_key': abyo.hash_prefix.hexdigest()}, f, indent=2)
+
+  # preprocessing (or cached time series only)
+  abyo.process_timeseries_data(cache_only=args.plot_only)
+
+  # save results concurrently (they only read the time series, so disk writes overlap the plot rendering)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+    futures = []
 
-  # preprocessing
-  abyo.process_timeseries_data()
+    # create plot
+    futures.append(executor.submit(abyo.save_occurrences_plot, df=abyo.df_timeseries, folder=folder))
 
-  # create plot
-  abyo.save_occurrences_plot(df=abyo.df_timeseries, folder=folder)
+    # save timeseries in csv (or parquet) file
+    futures.append(executor.submit(abyo.save_dataset, df=abyo.df_timeseries, path=folder+'/timeseries['+name_dates+','+name_moc+'].'+('parquet' if args.parquet else 'csv')))
 
-  # save timeseries in csv file
-  abyo.save_dataset(df=abyo.df_timeseries, path=folder+'/timeseries[dstart='+str(args.date_start)+',dend='+str(args.date_end)+',dstart2='+str(args.date_start2)+',dend2='+str(args.date_end2)+',moc='+str(args.min_occurrence)+'].csv')
+    # save geojson occurrences and clouds
+    for year, df_year in abyo.df_timeseries.groupby('year', sort=True):
+      futures.append(executor.submit(abyo.save_occurrences_geojson, df=df_year, path=folder+'/occurrences[y='+str(float(year))+','+name_dates+','+name_moc+'].json'))
 
-  # save geojson occurrences and clouds
-  for year in abyo.df_timeseries.groupby('year')['year'].agg('mean').values:
-    abyo.save_occurrences_geojson(df=abyo.df_timeseries[abyo.df_timeseries['year']==year], path=folder+'/occurrences[y='+str(year)+',dstart='+str(args.date_start)+',dend='+str(args.date_end)+',dstart2='+str(args.date_start2)+',dend2='+str(args.date_end2)+',moc='+str(args.min_occurrence)+'].json')
+    # wait for all of them (raising their errors)
+    for future in futures:
+      future.result()
 
   # save images to Local Folder (first try, based on image size) or to your Google Drive
   #abyo.save_collection_tiff(folder=folder+"/tiff", folderName=args.name+"_"+version, rgb=False)
 
   # results
-  # add results and save it on disk
-  abyo.df_timeseries = abyo.df_timeseries.drop(['label'], axis=1)
-  path_df_timeseries = folderRoot+'/results[moc='+str(args.min_occurrence)+'].csv'
-  df_timeseries = pd.read_csv(path_df_timeseries).drop(['Unnamed: 0'], axis=1, errors="ignore").append(abyo.df_timeseries) if os.path.exists(path_df_timeseries) else abyo.df_timeseries.copy(deep=True)
-  df_timeseries.to_csv(r''+path_df_timeseries)
+  # add results and save it on disk (already added by the run that built the cache)
+  if not args.plot_only:
+    abyo.df_timeseries = abyo.df_timeseries.drop(['label'], axis=1)
+    path_df_timeseries = folderRoot+'/results['+name_moc+'].csv'
+    df_timeseries = pd.read_csv(path_df_timeseries).drop(['Unnamed: 0'], axis=1, errors="ignore").append(abyo.df_timeseries) if os.path.exists(path_df_timeseries) else abyo.df_timeseries.copy(deep=True)
+    df_timeseries.to_csv(r''+path_df_timeseries)
 
   # ### Script termination notice
-  script_time_all = time.time() - start_time
-  debug = "***** Script execution completed successfully (-- %s seconds --) *****" %(script_time_all)
-  print()
-  print(debug)
+  script_time_all = time.perf_counter() - start_time
+  debug = "***** Script execution completed successfully (-- %.2f seconds --) *****" %(script_time_all)
+  logging.info(debug)
 
 except:
 
     # ### Script execution error warning
 
     # Execution
-    print()
-    print()
     debug = "***** Error on script execution: "+str(traceback.format_exc())
-    print(debug)
+    logging.error(debug)
 
     # Removes the folder created initially with the result of execution
-    script_time_all = time.time() - start_time
-    debug = "***** Script execution could not be completed (-- %s seconds --) *****" %(script_time_all)
-    print(debug)
+    script_time_all = time.perf_counter() - start_time
+    debug = "***** Script execution could not be completed (-- %.2f seconds --) *****" %(script_time_all)
+    logging.error(debug)